@@ -20,6 +20,7 @@ from litgpt.config import Config as BaseConfig
 from litgpt.model import GPT as BaseModel
 from litgpt.model import Block as BaseBlock
 from litgpt.model import CausalSelfAttention as BaseCausalSelfAttention
+from litgpt.model import additive_attention_mask
 
 
 @dataclass
@@ -59,18 +60,19 @@ class GPT(BaseModel):
             raise ValueError(f"Cannot forward sequence of length {T}, max seq length is only {self.max_seq_length}.")
 
         if input_pos is not None:  # use the kv cache
-            _device = self.cos.device
-            cos = self.cos.index_select(0, input_pos.to(_device))
-            sin = self.sin.index_select(0, input_pos.to(_device))
+            cos = self.cos.index_select(0, input_pos)
+            sin = self.sin.index_select(0, input_pos)
             if self.mask_cache is None:
                 raise TypeError("You need to call `gpt.set_kv_cache()`")
-            mask = self.mask_cache.index_select(2, input_pos)
+            mask = self.mask_cache <= input_pos.unsqueeze(-1)  # (1, 1, T, max_seq_length)
         else:
             cos = self.cos[:T]
             sin = self.sin[:T]
             mask = None
 
         x = self.transformer.wte(idx)  # token embeddings of shape (b, t, n_embd)
+        if mask is not None:
+            mask = additive_attention_mask(mask, x.dtype)
         if self.config.scale_embeddings:
             x = x * (self.config.n_embd**0.5)
         for block in self.transformer.h:
@@ -106,6 +108,7 @@ class Block(BaseBlock):
         self.mlp = config.mlp_class(config)
 
         self.config = config
+        self._specialize_forward()
 
 
 class CausalSelfAttention(BaseCausalSelfAttention):
@@ -138,16 +141,12 @@ class CausalSelfAttention(BaseCausalSelfAttention):
         else:
             prefix = self.adapter_wte.weight.reshape(1, aT, self.config.n_embd)
             aqkv = self.attn(prefix)
-            q_per_kv = self.config.n_head // self.config.n_query_groups
-            aqkv = aqkv.view(1, aT, self.config.n_query_groups, q_per_kv + 2, self.config.head_size)
-            aqkv = aqkv.permute(0, 2, 3, 1, 4)
-            _, ak, av = aqkv.split((q_per_kv, 1, 1), dim=2)
+            _, ak, av = self.split_qkv(aqkv)  # (1, nh_ak, aT, hs)
             if self.config.n_query_groups != 1:
                 # for MHA this is a no-op
-                ak = ak.repeat_interleave(q_per_kv, dim=2)
-                av = av.repeat_interleave(q_per_kv, dim=2)
-            ak = ak.view(1, -1, aT, self.config.head_size)  # (1, nh_ak, aT, hs)
-            av = av.view(1, -1, aT, self.config.head_size)  # (1, nh_av, aT, hs)
+                q_per_kv = self.config.n_head // self.config.n_query_groups
+                ak = ak.repeat_interleave(q_per_kv, dim=1)
+                av = av.repeat_interleave(q_per_kv, dim=1)
             self.adapter_kv_cache = (ak, av)
 
         T = q.size(2)
@@ -21,7 +21,7 @@ from litgpt.adapter import GPT as BaseModel
 from litgpt.adapter import Block as BaseBlock
 from litgpt.adapter import CausalSelfAttention as BaseCausalSelfAttention
 from litgpt.adapter import Config as BaseConfig
-from litgpt.model import KVCache
+from litgpt.model import KVCache, additive_attention_mask, normalize_head_weight
 from litgpt.utils import map_old_state_dict_weights
 
 import torch.nn.functional as F
@@ -66,11 +66,12 @@ class AdapterV2Linear(torch.nn.Module):
 
 
 class AdapterV2NormHead(torch.nn.Module):
+    weight_normalized = False
+
     def __init__(self, in_features, out_features, bias=False):
         super().__init__()
         self.weight = nn.Parameter(torch.empty((out_features, in_features)))
         nn.init.kaiming_uniform_(self.weight, a=math.sqrt(5))
-        self.first_flag = True
 
         self.adapter_bias = torch.nn.Parameter(torch.zeros(out_features), requires_grad=False)
         self.adapter_scale = torch.nn.Parameter(torch.ones(out_features), requires_grad=False)
@@ -79,16 +80,13 @@ class AdapterV2NormHead(torch.nn.Module):
         nn.init.zeros_(self.adapter_bias)
         nn.init.ones_(self.adapter_scale)
 
+    def train(self, mode: bool = True) -> Self:
+        # the normalized weight is constant during inference: normalize it once here instead of in `forward`
+        normalize_head_weight(self, normalize=not mode)
+        return super().train(mode)
+
     def forward(self, hidden_states):
-        if self.training:
-            norm_weight = nn.functional.normalize(self.weight)
-            self.first_flag = True
-        elif self.first_flag:
-            self.first_flag = False
-            self.weight.data = nn.functional.normalize(self.weight)
-            norm_weight = self.weight
-        else:
-            norm_weight = self.weight
+        norm_weight = self.weight if self.weight_normalized else nn.functional.normalize(self.weight)
         out = nn.functional.linear(hidden_states, norm_weight)
         return self.adapter_scale * (out + self.adapter_bias)
 
@@ -99,6 +97,8 @@ class AdapterV2NormHead(torch.nn.Module):
         }
         state_dict = map_old_state_dict_weights(state_dict, mapping, prefix)
         super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+        # weights loaded after `eval()` was called still need to be normalized
+        normalize_head_weight(self, normalize=not self.training)
 
 
 class GPT(BaseModel):
@@ -134,13 +134,15 @@ class GPT(BaseModel):
             sin = self.sin.index_select(0, input_pos)
             if self.mask_cache is None:
                 raise TypeError("You need to call `gpt.set_kv_cache()`")
-            mask = self.mask_cache.index_select(2, input_pos)
+            mask = self.mask_cache <= input_pos.unsqueeze(-1)  # (1, 1, T, max_seq_length)
         else:
             cos = self.cos[:T]
             sin = self.sin[:T]
             mask = None
 
         x = self.transformer.wte(idx)  # token embeddings of shape (b, t, n_embd)
+        if mask is not None:
+            mask = additive_attention_mask(mask, x.dtype)
         if self.config.scale_embeddings:
             x = x * (self.config.n_embd**0.5)
         for block in self.transformer.h:
@@ -182,6 +184,7 @@ class Block(BaseBlock):
         self.mlp = config.mlp_class(config)
 
         self.config = config
+        self._specialize_forward()
 
 
 class CausalSelfAttention(BaseCausalSelfAttention):
@@ -199,6 +202,8 @@ class CausalSelfAttention(BaseCausalSelfAttention):
         self.proj = AdapterV2Linear(config.head_size * config.n_head, config.n_embd, bias=config.bias)
         # disabled by default
         self.kv_cache: Optional[KVCache] = None
+        # `None` lets SDPA use its default scaling
+        self.scale = 1.0 / math.sqrt(config.head_size) if config.add_attention_scale else None
 
         if block_idx >= config.adapter_start_layer:
             # adapter embedding layer
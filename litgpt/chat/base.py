@@ -14,7 +14,13 @@ from litgpt import GPT, Config, PromptStyle, Tokenizer
 from litgpt.generate.base import next_token
 from litgpt.prompts import has_prompt_style, load_prompt_style
 from litgpt.scripts.merge_lora import merge_lora
-from litgpt.utils import CLI, check_valid_checkpoint_dir, get_default_supported_precision, load_checkpoint
+from litgpt.utils import (
+    CLI,
+    check_valid_checkpoint_dir,
+    get_default_supported_precision,
+    load_checkpoint,
+    quantize_torchao,
+)
 
 
 @torch.inference_mode()
@@ -106,7 +112,9 @@ def main(
     top_k: Optional[int] = 200,
     temperature: float = 0.8,
     checkpoint_dir: Path = Path("checkpoints/stabilityai/stablelm-tuned-alpha-3b"),
-    quantize: Optional[Literal["bnb.nf4", "bnb.nf4-dq", "bnb.fp4", "bnb.fp4-dq", "bnb.int8"]] = None,
+    quantize: Optional[
+        Literal["bnb.nf4", "bnb.nf4-dq", "bnb.fp4", "bnb.fp4-dq", "bnb.int8", "torchao.int8wo", "torchao.fp8wo"]
+    ] = None,
     precision: Optional[str] = None,
     compile: bool = False,
     max_seq_length: Optional[int] = 512,
@@ -124,6 +132,7 @@ def main(
         quantize: Whether to quantize the model and using which method:
             - bnb.nf4, bnb.nf4-dq, bnb.fp4, bnb.fp4-dq: 4-bit quantization from bitsandbytes
             - bnb.int8: 8-bit quantization from bitsandbytes
+            - torchao.int8wo, torchao.fp8wo: int8 or float8 weight-only quantization from torchao
             for more details, see https://github.com/Lightning-AI/litgpt/blob/main/tutorials/quantize.md
         precision: Indicates the Fabric precision setting to use.
         compile: Whether to use compilation to speed up token generation. Will increase startup time.
@@ -139,6 +148,8 @@ def main(
         dtype = {"16-true": torch.float16, "bf16-true": torch.bfloat16, "32-true": torch.float32}[precision]
         plugins = BitsandbytesPrecision(quantize[4:], dtype)
         precision = None
+    if quantize is not None and quantize.startswith("torchao.") and "mixed" in precision:
+        raise ValueError("Quantization and mixed precision is not supported.")
 
     fabric = L.Fabric(devices=1, precision=precision, plugins=plugins)
 
@@ -165,6 +176,10 @@ def main(
         model.load_state_dict(state_dict)
     else:
         load_checkpoint(fabric, model, checkpoint_path)
+    for block in model.transformer.h:
+        block.attn.use_flat_qkv_layout()
+    if quantize is not None and quantize.startswith("torchao."):
+        quantize_torchao(model, quantize)
     model.eval()
 
     if compile:
@@ -77,6 +77,11 @@ class Config:
     moe_intermediate_size: Optional[int] = None
     shared_expert_intermediate_size: Optional[int] = None
 
+    # compile `Block.forward` with `torch.compile(mode="reduce-overhead")`, once for all the blocks
+    compile_block: bool = False
+    # compile `RMSNorm` into a single fused kernel
+    fused_rmsnorm: bool = False
+
     def __post_init__(self):
         if not self.name:
             self.name = self.hf_config.get("name", self.name)
@@ -155,7 +160,7 @@ class Config:
 
             from litgpt.model import RMSNorm
 
-            return partial(RMSNorm, add_unit_offset="Gemma" in self.name)
+            return partial(RMSNorm, add_unit_offset="Gemma" in self.name, fused=self.fused_rmsnorm)
         return getattr(torch.nn, self.norm_class_name)
 
 
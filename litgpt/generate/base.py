@@ -13,7 +13,13 @@ from lightning.fabric.plugins import BitsandbytesPrecision
 
 from litgpt import GPT, Config, PromptStyle, Tokenizer
 from litgpt.prompts import has_prompt_style, load_prompt_style
-from litgpt.utils import CLI, check_valid_checkpoint_dir, get_default_supported_precision, load_checkpoint
+from litgpt.utils import (
+    CLI,
+    check_valid_checkpoint_dir,
+    get_default_supported_precision,
+    load_checkpoint,
+    quantize_torchao,
+)
 
 
 def multinomial_num_samples_1(probs: torch.Tensor) -> torch.Tensor:
@@ -99,9 +105,13 @@ def main(
     top_k: Optional[int] = 50,
     temperature: float = 0.8,
     checkpoint_dir: Path = Path("checkpoints/stabilityai/stablelm-base-alpha-3b"),
-    quantize: Optional[Literal["bnb.nf4", "bnb.nf4-dq", "bnb.fp4", "bnb.fp4-dq", "bnb.int8"]] = None,
+    quantize: Optional[
+        Literal["bnb.nf4", "bnb.nf4-dq", "bnb.fp4", "bnb.fp4-dq", "bnb.int8", "torchao.int8wo", "torchao.fp8wo"]
+    ] = None,
     precision: Optional[str] = None,
     compile: bool = False,
+    cuda_graph: bool = False,
+    consolidate_weights: bool = False,
 ) -> None:
     """Generates text samples based on a pre-trained model and tokenizer.
 
@@ -116,11 +126,21 @@ def main(
         quantize: Whether to quantize the model and using which method:
             - bnb.nf4, bnb.nf4-dq, bnb.fp4, bnb.fp4-dq: 4-bit quantization from bitsandbytes
             - bnb.int8: 8-bit quantization from bitsandbytes
+            - torchao.int8wo, torchao.fp8wo: int8 or float8 weight-only quantization from torchao
             for more details, see https://github.com/Lightning-AI/litgpt/blob/main/tutorials/quantize.md
         precision: Indicates the Fabric precision setting to use.
         compile: Whether to compile the model.
+        cuda_graph: Whether to replay the single token decode step from a CUDA graph. Not compatible with `compile`,
+            which already captures CUDA graphs, nor with mixed precision or mixture of experts models.
+        consolidate_weights: Whether to store the weights of all the layers in contiguous stacked tensors. Needs one
+            extra copy of the largest per-layer weight across all the layers while loading.
     """
+    if compile and cuda_graph:
+        raise ValueError("`compile` already uses CUDA graphs, set only one of `compile` and `cuda_graph`.")
     precision = precision or get_default_supported_precision(training=False)
+    if cuda_graph and "mixed" in precision:
+        # autocast changes the dtype of the activations, which reallocates the kv cache after the capture
+        raise ValueError("`cuda_graph` and mixed precision is not supported, use a `-true` precision.")
 
     plugins = None
     if quantize is not None and quantize.startswith("bnb."):
@@ -129,8 +149,12 @@ def main(
         dtype = {"16-true": torch.float16, "bf16-true": torch.bfloat16, "32-true": torch.float32}[precision]
         plugins = BitsandbytesPrecision(quantize[4:], dtype)
         precision = None
+    if quantize is not None and quantize.startswith("torchao.") and "mixed" in precision:
+        raise ValueError("Quantization and mixed precision is not supported.")
 
     fabric = L.Fabric(devices=1, precision=precision, plugins=plugins)
+    if cuda_graph and fabric.device.type != "cuda":
+        raise ValueError(f"`cuda_graph` requires a CUDA device, got {fabric.device.type!r}.")
 
     check_valid_checkpoint_dir(checkpoint_dir)
     config = Config.from_file(checkpoint_dir / "model_config.yaml")
@@ -170,8 +194,19 @@ def main(
 
     t0 = time.perf_counter()
     load_checkpoint(fabric, model, checkpoint_path)
+    for block in model.transformer.h:
+        block.attn.use_flat_qkv_layout()
+    if quantize is not None and quantize.startswith("torchao."):
+        quantize_torchao(model, quantize)
+    if consolidate_weights:
+        model.consolidate_weights()
     fabric.print(f"Time to load the model weights: {time.perf_counter() - t0:.02f} seconds.", file=sys.stderr)
 
+    if cuda_graph:
+        t0 = time.perf_counter()
+        model.capture_decode_graph(batch_size=1)
+        fabric.print(f"Time to capture the decode graph: {time.perf_counter() - t0:.02f} seconds.", file=sys.stderr)
+
     L.seed_everything(1234)
     for i in range(num_samples):
         t0 = time.perf_counter()
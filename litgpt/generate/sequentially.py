@@ -44,7 +44,9 @@ def sequential(model: GPT, root: torch.device, max_seq_length: int, devices: int
         # in case the checkpoint was partial, materialize leftover metas
         _materialize_meta_tensors(submodule, target_device)
         # and build the kv cache
-        submodule.attn.kv_cache = submodule.attn.build_kv_cache(1, max_seq_length, model.cos.size(-1), target_device)
+        submodule.attn.kv_cache = submodule.attn.build_kv_cache(
+            1, max_seq_length, 2 * model.cos.size(-1), target_device, model.transformer.wte.weight.dtype
+        )
     # rebuild odd ends
     with root:
         model.max_seq_length = max_seq_length
@@ -57,7 +57,7 @@ from litgpt.config import Config as BaseConfig
 from litgpt.model import GPT as BaseModel
 from litgpt.model import Block as BaseBlock
 from litgpt.model import CausalSelfAttention as BaseCausalSelfAttention
-from litgpt.model import KVCache
+from litgpt.model import KVCache, additive_attention_mask, normalize_head_weight
 from litgpt.utils import map_old_state_dict_weights
 
 
@@ -173,6 +173,8 @@ class LoRALinear(LoRALayer):
 
 
 class LoRANormHead(LoRALinear):
+    weight_normalized = False
+
     def __init__(
         self,
         in_features: int,
@@ -188,7 +190,6 @@ class LoRANormHead(LoRALinear):
         )
         self.weight = nn.Parameter(torch.empty((out_features, in_features)))
         nn.init.kaiming_uniform_(self.weight, a=math.sqrt(5))
-        self.first_flag = True
 
         # Actual trainable parameters
         if r > 0:
@@ -201,17 +202,14 @@ class LoRANormHead(LoRALinear):
         # diable merge for now
         self.merged = False
 
+    def train(self, mode: bool = True) -> Self:
+        # the normalized weight is constant during inference: normalize it once here instead of in `forward`
+        normalize_head_weight(self, normalize=not mode)
+        return super().train(mode)
+
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         # only norm the pretrained weight
-        if self.training:
-            norm_weight = nn.functional.normalize(self.weight)
-            self.first_flag = True
-        elif self.first_flag:
-            self.first_flag = False
-            self.weight.data = nn.functional.normalize(self.weight)
-            norm_weight = self.weight
-        else:
-            norm_weight = self.weight
+        norm_weight = self.weight if self.weight_normalized else nn.functional.normalize(self.weight)
         pretrained = nn.functional.linear(x, norm_weight)
         if self.r == 0 or self.merged:
             return pretrained
@@ -226,6 +224,8 @@ class LoRANormHead(LoRALinear):
         }
         state_dict = map_old_state_dict_weights(state_dict, mapping, prefix)
         super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+        # weights loaded after `eval()` was called still need to be normalized
+        normalize_head_weight(self, normalize=not self.training)
 
 
 class LoRAQKVLinear(LoRALinear):
@@ -594,18 +594,19 @@ class GPT(BaseModel):
             raise ValueError(f"Cannot forward sequence of length {T}, max seq length is only {self.max_seq_length}.")
 
         if input_pos is not None:  # use the kv cache
-            _device = self.cos.device
-            cos = self.cos.index_select(0, input_pos.to(_device))
-            sin = self.sin.index_select(0, input_pos.to(_device))
+            cos = self.cos.index_select(0, input_pos)
+            sin = self.sin.index_select(0, input_pos)
             if self.mask_cache is None:
                 raise TypeError("You need to call `gpt.set_kv_cache()`")
-            mask = self.mask_cache.index_select(2, input_pos)
+            mask = self.mask_cache <= input_pos.unsqueeze(-1)  # (1, 1, T, max_seq_length)
         else:
             cos = self.cos[:T]
             sin = self.sin[:T]
             mask = None
 
         x = self.transformer.wte(idx)  # token embeddings of shape (b, t, n_embd)
+        if mask is not None:
+            mask = additive_attention_mask(mask, x.dtype)
         if self.config.scale_embeddings:
             x = x * (self.config.n_embd**0.5)
         for block in self.transformer.h:
@@ -643,6 +644,7 @@ class Block(BaseBlock):
         self.mlp = config.mlp_class(config)
 
         self.config = config
+        self._specialize_forward()
 
 
 class CausalSelfAttention(BaseCausalSelfAttention):
@@ -677,6 +679,8 @@ class CausalSelfAttention(BaseCausalSelfAttention):
         )
         # disabled by default
         self.kv_cache: Optional[KVCache] = None
+        # `None` lets SDPA use its default scaling
+        self.scale = 1.0 / math.sqrt(config.head_size) if config.add_attention_scale else None
 
         self.config = config
 
@@ -785,11 +789,7 @@ class ChatGLM2MLP(litgpt.model.ChatGLM2MLP):
             lora_dropout=config.lora_dropout,
         )
 
-        def swiglu(x):
-            x = torch.chunk(x, 2, dim=-1)
-            return F.silu(x[0]) * x[1]
-
-        self.activation_func = swiglu
+        self.activation_func = litgpt.model.swiglu
 
         self.dense_4h_to_h = LoRALinear(
             config.intermediate_size,
@@ -7,18 +7,28 @@ https://github.com/EleutherAI/gpt-neox/tree/main/megatron/model.
 """
 
 import math
-from typing import Any, Optional, Tuple
+from functools import lru_cache
+from typing import Any, Callable, Dict, Optional, Tuple
 
 import torch
 import torch.nn as nn
 from typing_extensions import Self
 
 import torch.nn.functional as F
+from lightning_utilities.core.imports import RequirementCache
+
 from litgpt.config import Config
 from litgpt.misc import alibi
 
+_TORCH_GREATER_EQUAL_2_5 = bool(RequirementCache("torch>=2.5.0"))
+_FLASH_ATTN_AVAILABLE = bool(RequirementCache("flash-attn>=2.0"))
+
 
 class GPT(nn.Module):
+    # the CUDA graph of the single token decode step with its static input and output tensors, see
+    # `capture_decode_graph`
+    decode_graph: Optional[Tuple["torch.cuda.CUDAGraph", torch.Tensor, torch.Tensor, torch.Tensor]] = None
+
     def __init__(self, config: Config) -> None:
         super().__init__()
         assert config.padded_vocab_size is not None
@@ -47,10 +57,15 @@ class GPT(nn.Module):
         """
         When doing inference, the sequences used might be shorter than the model's context length.
         This allows setting a smaller number to avoid allocating unused memory
+
+        The rope cache and the alibi mask are buffers: they are rebuilt on the device they live on and move together with
+        the module, so `forward` never needs to check their device.
         """
         if value > self.config.block_size:
             raise ValueError(f"Cannot attend to {value}, block size is only {self.config.block_size}")
         self._max_seq_length = value
+        # the captured graph reads the previous caches
+        self.decode_graph = None
         if self.config.position_emb_type == "rope":
             if not hasattr(self, "cos"):
                 # first call
@@ -60,7 +75,10 @@ class GPT(nn.Module):
             # overrides
             elif self.cos.device.type == "meta":
                 self.cos, self.sin = self.rope_cache()
-            elif value != self.cos.size(0):
+            elif value < self.cos.size(0):
+                # the angles of a position do not depend on the cache length, so a shorter cache is a prefix
+                self.cos, self.sin = self.cos[:value].clone(), self.sin[:value].clone()
+            elif value > self.cos.size(0):
                 self.cos, self.sin = self.rope_cache(device=self.cos.device)
             # the mask and kv cache size will get updated on `set_kv_cache`. we cannot update it here because we don't know
             # if the kv cache is expected
@@ -71,7 +89,7 @@ class GPT(nn.Module):
                     alibi.build_alibi_mask(self.config.n_head, value),
                     persistent=False,
                 )
-            elif value != self.future_mask.size(0):
+            elif value != self.future_mask.size(-1):
                 self.future_mask = alibi.build_alibi_mask(self.config.n_head,
                                                           value).to(self.future_mask.device)
 
@@ -89,26 +107,21 @@ class GPT(nn.Module):
             torch.nn.init.normal_(module.weight, mean=0.0, std=0.02)
 
     def forward(self, idx: torch.Tensor, input_pos: Optional[torch.Tensor] = None) -> torch.Tensor:
+        if self.decode_graph is not None and input_pos is not None and idx.shape == self.decode_graph[1].shape:
+            return self.replay_decode_graph(idx, input_pos)
         T = idx.size(1)
         if self.max_seq_length < T:
             raise ValueError(f"Cannot forward sequence of length {T}, max seq length is only {self.max_seq_length}.")
 
         cos, sin = None, None
         if input_pos is not None:  # use the kv cache
-            max_pos = torch.max(input_pos) + 1
             if self.mask_cache is None:
                 raise TypeError("You need to call `gpt.set_kv_cache()`")
             if self.config.position_emb_type == "rope":
-                if self.cos.device != idx.device:
-                    self.cos = self.cos.to(idx.device)
-                    self.sin = self.sin.to(idx.device)
                 cos = self.cos.index_select(0, input_pos)
                 sin = self.sin.index_select(0, input_pos)
-                mask = self.mask_cache.index_select(2, input_pos)
-            elif self.config.position_emb_type == "alibi":
-                mask = self.mask_cache[:, :, :max_pos, :]
+            mask = self.mask_cache <= input_pos.unsqueeze(-1)  # (1, 1, T, max_seq_length)
         else:
-            max_pos = T
             if self.config.position_emb_type == "rope":
                 cos = self.cos[:T]
                 sin = self.sin[:T]
@@ -117,14 +130,15 @@ class GPT(nn.Module):
 
         if self.config.position_emb_type == "alibi":
             # TODO(metame): training may be different
-            if self.future_mask.device != x.device:
-                self.future_mask = self.future_mask.to(x.device)
-            alibi_mask = self.future_mask[:self.config.n_head, :max_pos, :max_pos]
             if mask is not None:
-                mask = mask[..., :max_pos]
+                # attend over the whole kv cache so that the shapes do not depend on the values in `input_pos`.
+                # the positions that were not written yet are masked out
+                alibi_mask = self.future_mask[: self.config.n_head].index_select(1, input_pos)
                 mask = self.update_alibi_attention_mask(x, mask, alibi_mask)
             else:
-                mask = alibi_mask
+                mask = self.future_mask[: self.config.n_head, :T, :T]
+        elif mask is not None:
+            mask = additive_attention_mask(mask, x.dtype)
 
         if self.config.scale_embeddings:
             x = x * (self.config.n_embd**0.5)
@@ -160,7 +174,15 @@ class GPT(nn.Module):
         dtype: Optional[torch.dtype] = None,
     ) -> None:
         if rope_cache_length is None and self.config.position_emb_type == "rope":
-            rope_cache_length = self.cos.size(-1)
+            # the rope cache only stores one half of the rotated dimensions
+            rope_cache_length = 2 * self.cos.size(-1)
+        if dtype is None:
+            # allocate the cache in the dtype of the activations so that it doesn't need to be converted every step
+            dtype = self.transformer.wte.weight.dtype
+        if device is not None and self.config.position_emb_type == "rope":
+            # keep the rope cache next to the kv cache instead of moving it inside `forward`
+            self.cos = self.cos.to(device)
+            self.sin = self.sin.to(device)
         max_seq_length = self.max_seq_length
 
         # initialize the kv cache for all blocks
@@ -173,14 +195,100 @@ class GPT(nn.Module):
             # passing `attn_mask` to SDPA disables the flash implementation. since we only need the mask
             # for the kv-cache support (only during inference), we only create it in that situation
             self.mask_cache = build_mask_cache(max_seq_length, device)
+        self.decode_graph = None
 
     def clear_kv_cache(self) -> None:
         self.mask_cache = None
+        self.decode_graph = None
         for block in self.transformer.h:
             block.attn.kv_cache = None
 
+    @torch.no_grad()
+    def consolidate_weights(self) -> None:
+        """Stores each parameter of the blocks in a single (n_layer, ...) tensor that the blocks hold views of.
+
+        The weights of consecutive layers then sit next to each other in memory instead of in separate allocations.
+        The modules and the state dict keys are unchanged, and loading a state dict afterwards copies into the views.
+        Parameters that are missing from some blocks, that differ in shape or that are quantized (parameter subclasses
+        like the bitsandbytes ones, or tensor subclasses like the torchao ones) are left as they are. Stacking needs
+        one extra copy of a parameter across all the layers at a time.
+        """
+        blocks = self.transformer.h
+        for name, param in blocks[0].named_parameters():
+            params = []
+            for block in blocks:
+                try:
+                    params.append(block.get_parameter(name))
+                except AttributeError:
+                    break
+            if len(params) != len(blocks) or any(
+                type(p) is not nn.Parameter
+                or type(p.data) is not torch.Tensor
+                or p.shape != param.shape or p.dtype != param.dtype for p in params
+            ):
+                continue
+            stacked = torch.stack(params)
+            module_name, _, param_name = name.rpartition(".")
+            for block, p, weight in zip(blocks, params, stacked.unbind(0)):
+                setattr(block.get_submodule(module_name), param_name, nn.Parameter(weight, p.requires_grad))
+
+    @torch.inference_mode()
+    def capture_decode_graph(self, batch_size: int = 1) -> None:
+        """Records the single token decode step into a CUDA graph that `forward` replays for inputs of shape
+        (batch_size, 1), which removes the launch overhead of every kernel.
+
+        Call it after `set_kv_cache` and once the weights are loaded, but before the prompt is processed: the warm-up
+        steps write into the first position of the kv cache. The returned logits are a static tensor that the next
+        replay overwrites. The graph is recorded for the dtype of the kv cache, so the model has to run in that dtype
+        afterwards.
+        """
+        if self.mask_cache is None:
+            raise TypeError("You need to call `gpt.set_kv_cache()`")
+        if any(isinstance(block.mlp, (LLaMAMoE, Qwen2MoE)) for block in self.transformer.h):
+            raise NotImplementedError(
+                "CUDA graphs are not supported for mixture of experts models: routing the tokens to the experts"
+                " synchronizes with the host."
+            )
+        self.decode_graph = None
+        device = self.mask_cache.device
+        if device.type != "cuda":
+            raise ValueError(f"CUDA graphs require the kv cache on a CUDA device, got {device.type!r}")
+        static_idx = torch.zeros(batch_size, 1, dtype=torch.long, device=device)
+        static_pos = torch.zeros(1, dtype=torch.long, device=device)
+        # warm up on a side stream so that the lazy initializations are not recorded
+        stream = torch.cuda.Stream(device)
+        stream.wait_stream(torch.cuda.current_stream(device))
+        with torch.cuda.stream(stream):
+            for _ in range(3):
+                self(static_idx, static_pos)
+        torch.cuda.current_stream(device).wait_stream(stream)
+        graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(graph):
+            static_out = self(static_idx, static_pos)
+        self.decode_graph = (graph, static_idx, static_pos, static_out, self._kv_cache_ptrs())
+
+    def replay_decode_graph(self, idx: torch.Tensor, input_pos: torch.Tensor) -> torch.Tensor:
+        graph, static_idx, static_pos, static_out, kv_cache_ptrs = self.decode_graph
+        if self._kv_cache_ptrs() != kv_cache_ptrs:
+            # `KVCache` converts its buffers when the activations change dtype, e.g. a prefill under autocast
+            raise RuntimeError(
+                "The kv cache was reallocated after `capture_decode_graph`, run the model in the dtype of the kv cache"
+                " or call `capture_decode_graph` again before processing the prompt."
+            )
+        static_idx.copy_(idx)
+        static_pos.copy_(input_pos)
+        graph.replay()
+        return static_out
+
+    def _kv_cache_ptrs(self) -> Tuple[int, ...]:
+        kv_caches = [block.attn.kv_cache for block in self.transformer.h]
+        return tuple(ptr for kv_cache in kv_caches for ptr in (kv_cache.k.data_ptr(), kv_cache.v.data_ptr()))
+
 
 class Block(nn.Module):
+    # the unbound forward variant, not a bound method, so that the block does not reference itself
+    _forward_impl: Optional[Callable] = None
+
     def __init__(self, config: Config) -> None:
         super().__init__()
         if not config.parallel_residual and config.shared_attention_norm:
@@ -195,6 +303,19 @@ class Block(nn.Module):
         self.mlp = config.mlp_class(config)
 
         self.config = config
+        self._specialize_forward()
+
+    def _specialize_forward(self) -> None:
+        """Selects the forward variant for this block's residual structure so it runs without branches."""
+        if not self.config.parallel_residual:
+            forward = type(self)._forward_sequential
+        elif self.config.shared_attention_norm:
+            forward = type(self)._forward_parallel_shared_norm
+        else:
+            forward = type(self)._forward_parallel
+        if self.config.compile_block:
+            forward = _compiled_block_forward(forward, self.config.n_layer)
+        self._forward_impl = forward
 
     def forward(
         self,
@@ -218,21 +339,72 @@ class Block(nn.Module):
         │     mlp
         │     ↓
         └───► +
+
+        `__init__` selects the variant for the configured structure, see `_specialize_forward`. Blocks built without it
+        select it on their first call.
         """
+        if self._forward_impl is None:
+            self._specialize_forward()
+        return self._forward_impl(self, x, cos, sin, mask, input_pos)
+
+    def _forward_sequential(
+        self,
+        x: torch.Tensor,
+        cos: torch.Tensor,
+        sin: torch.Tensor,
+        mask: Optional[torch.Tensor] = None,
+        input_pos: Optional[torch.Tensor] = None,
+    ) -> torch.Tensor:
+        x = self.attn(self.norm_1(x), cos, sin, mask, input_pos) + x
+        return self.mlp(self.norm_2(x)) + x
+
+    def _forward_parallel(
+        self,
+        x: torch.Tensor,
+        cos: torch.Tensor,
+        sin: torch.Tensor,
+        mask: Optional[torch.Tensor] = None,
+        input_pos: Optional[torch.Tensor] = None,
+    ) -> torch.Tensor:
+        return self.mlp(self.norm_2(x)) + self.attn(self.norm_1(x), cos, sin, mask, input_pos) + x
 
+    def _forward_parallel_shared_norm(
+        self,
+        x: torch.Tensor,
+        cos: torch.Tensor,
+        sin: torch.Tensor,
+        mask: Optional[torch.Tensor] = None,
+        input_pos: Optional[torch.Tensor] = None,
+    ) -> torch.Tensor:
         x_normed = self.norm_1(x)
-        attention_output = self.attn(x_normed, cos, sin, mask, input_pos)
+        return self.mlp(x_normed) + self.attn(x_normed, cos, sin, mask, input_pos) + x
 
-        if self.config.parallel_residual:
-            x_normed = x_normed if self.config.shared_attention_norm else self.norm_2(x)
-            x = self.mlp(x_normed) + attention_output + x
-        else:
-            x = attention_output + x
-            x = self.mlp(self.norm_2(x)) + x
-        return x
+
+# one compiled function per forward variant, shared by all the blocks
+_COMPILED_BLOCK_FORWARDS: Dict[Callable, Callable] = {}
+
+
+def _compiled_block_forward(forward: Callable, n_layer: int) -> Callable:
+    """Compiles a `Block` forward variant once for all the blocks.
+
+    Without `fullgraph` so that data-dependent code, like the expert dispatch of the MoE MLPs, falls back to eager instead
+    of failing. From torch 2.5 the blocks are inlined into a single graph. Before, Dynamo specializes on every block, so
+    the cache size limit is raised to keep the deeper layers from silently running in eager mode.
+    """
+    if not _TORCH_GREATER_EQUAL_2_5:
+        import torch._dynamo.config
+
+        torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, n_layer)
+    if forward not in _COMPILED_BLOCK_FORWARDS:
+        _COMPILED_BLOCK_FORWARDS[forward] = torch.compile(forward, mode="reduce-overhead")
+    return _COMPILED_BLOCK_FORWARDS[forward]
 
 
 class CausalSelfAttention(nn.Module):
+    # whether the rows of the qkv projection are ordered as [Q | K | V] instead of per query group (see
+    # `use_flat_qkv_layout`)
+    qkv_flat: bool = False
+
     def __init__(self, config: Config) -> None:
         super().__init__()
         shape = (config.n_head + 2 * config.n_query_groups) * config.head_size
@@ -243,6 +415,8 @@ class CausalSelfAttention(nn.Module):
         self.proj = nn.Linear(config.head_size * config.n_head, config.n_embd, bias=config.bias)
         # disabled by default
         self.kv_cache: Optional[KVCache] = None
+        # `None` lets SDPA use its default scaling
+        self.scale = 1.0 / math.sqrt(config.head_size) if config.add_attention_scale else None
 
         self.config = config
 
@@ -257,33 +431,30 @@ class CausalSelfAttention(nn.Module):
         B, T, C = x.size()  # batch size, sequence length, embedding dimensionality (n_embd)
 
         qkv = self.attn(x)
-
-        # assemble into a number of query groups to support MHA, MQA and GQA together (see `config.n_query_groups`)
-        q_per_kv = self.config.n_head // self.config.n_query_groups
-        total_qkv = q_per_kv + 2  # each group has 1+ queries, 1 key, and 1 value
-        qkv = qkv.view(B, T, self.config.n_query_groups, total_qkv, self.config.head_size)
-        qkv = qkv.permute(0, 2, 3, 1, 4)  # (B, n_query_groups, total_qkv, T, hs)
-
-        # split batched computation into three
-        q, k, v = qkv.split((q_per_kv, 1, 1), dim=2)
-
-        # maybe repeat k and v if for the non multi-head attention cases
-        # training: flash attention requires it
-        # inference: multi-query would require a full kv cache so avoid it to limit its memory usage
-        if self.config.n_query_groups != self.config.n_head and (input_pos is None or self.config.n_query_groups != 1):
-            k = k.expand(B, self.config.n_query_groups, q_per_kv, T, self.config.head_size)
-            v = v.expand(B, self.config.n_query_groups, q_per_kv, T, self.config.head_size)
-
-        q = q.reshape(B, -1, T, self.config.head_size)  # (B, nh_q, T, hs)
-        k = k.reshape(B, -1, T, self.config.head_size)  # (B, nh_k, T, hs)
-        v = v.reshape(B, -1, T, self.config.head_size)  # (B, nh_v, T, hs)
-
+        q, k, v = self.split_qkv(qkv)
 
         if self.config.position_emb_type == "rope":
-            q_roped = apply_rope(q[..., : self.config.rope_n_elem], cos, sin, self.config.rope_type)
-            k_roped = apply_rope(k[..., : self.config.rope_n_elem], cos, sin, self.config.rope_type)
-            q = torch.cat((q_roped, q[..., self.config.rope_n_elem :]), dim=-1)
-            k = torch.cat((k_roped, k[..., self.config.rope_n_elem :]), dim=-1)
+            n_elem = self.config.rope_n_elem
+            if torch.is_grad_enabled():
+                # q and k are views of the `split` outputs, which autograd does not allow to modify in place
+                q = torch.cat((apply_rope(q[..., :n_elem], cos, sin, self.config.rope_type), q[..., n_elem:]), dim=-1)
+                k = torch.cat((apply_rope(k[..., :n_elem], cos, sin, self.config.rope_type), k[..., n_elem:]), dim=-1)
+            else:
+                # rotate the first `rope_n_elem` dimensions in place, the rest of the head is left untouched
+                apply_rope_(q[..., :n_elem], cos, sin, self.config.rope_type)
+                apply_rope_(k[..., :n_elem], cos, sin, self.config.rope_type)
+
+        # repeat the key and value heads of the non multi-head attention cases when SDPA cannot broadcast them:
+        # training: flash attention requires it before torch 2.5 (`enable_gqa`).
+        # inference: the attention mask rules out the flash kernel and the memory-efficient one does not support GQA, so
+        # the new positions are repeated before they are stored. this keeps the cost at one expanded cache instead of
+        # repeating the whole cache every step. multi-query attention keeps its single head to limit the cache size
+        if k.size(1) != q.size(1) and (
+            (input_pos is None and not _TORCH_GREATER_EQUAL_2_5) or (input_pos is not None and k.size(1) != 1)
+        ):
+            q_per_kv = q.size(1) // k.size(1)
+            k = k.repeat_interleave(q_per_kv, dim=1)
+            v = v.repeat_interleave(q_per_kv, dim=1)
 
         if input_pos is not None:
             if not isinstance(self.kv_cache, KVCache):
@@ -292,10 +463,6 @@ class CausalSelfAttention(nn.Module):
 
         # NOTE: for baichuan2-13b
         if self.config.position_emb_type == "alibi" and "baichuan2-13b" in self.config.name:
-            if input_pos is not None:
-                max_pos = torch.max(input_pos) + 1
-                k = k[:, :, :max_pos, :]
-                v = v[:, :, :max_pos, :]
             y = self.attention_with_alibi(T, q, k, v, mask)
         else:
             y = self.scaled_dot_product_attention(q, k, v, mask)
@@ -305,15 +472,73 @@ class CausalSelfAttention(nn.Module):
         # output projection
         return self.proj(y)
 
+    def split_qkv(self, qkv: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """Splits the output of the qkv projection into queries of shape (B, nh_q, T, hs) and keys and values of shape
+        (B, nh_k, T, hs).
+
+        The key and value heads are not repeated for the non multi-head attention cases: the kv cache stores
+        `n_query_groups` heads and the replication is left to `scaled_dot_product_attention`.
+        """
+        B, T, _ = qkv.size()
+        head_size = self.config.head_size
+        if self.qkv_flat:
+            q_size = self.config.n_head * head_size
+            kv_size = self.config.n_query_groups * head_size
+            q, k, v = qkv.split((q_size, kv_size, kv_size), dim=-1)
+        else:
+            # assemble into a number of query groups to support MHA, MQA and GQA together (see `config.n_query_groups`)
+            q_per_kv = self.config.n_head // self.config.n_query_groups
+            total_qkv = q_per_kv + 2  # each group has 1+ queries, 1 key, and 1 value
+            qkv = qkv.view(B, T, self.config.n_query_groups, total_qkv, head_size)
+            # split batched computation into three
+            q, k, v = qkv.split((q_per_kv, 1, 1), dim=3)
+        q = q.reshape(B, T, -1, head_size).transpose(1, 2)  # (B, nh_q, T, hs)
+        k = k.reshape(B, T, -1, head_size).transpose(1, 2)  # (B, nh_k, T, hs)
+        v = v.reshape(B, T, -1, head_size).transpose(1, 2)  # (B, nh_v, T, hs)
+        return q, k, v
+
+    def use_flat_qkv_layout(self) -> None:
+        """Reorders the rows of the qkv projection from the per query group layout of the checkpoints to [Q | K | V].
+
+        The queries, keys and values are then plain views of the projection output, which avoids the copies needed to
+        gather the query heads of every group. Meant to be called once the weights are loaded for inference. The state
+        dict keeps the per query group layout so checkpoints stay interchangeable. LoRA, adapter-v2 and quantized
+        projections are left untouched.
+        """
+        if self.qkv_flat or type(self.attn) is not nn.Linear or not self.attn.weight.is_floating_point():
+            return
+        order = qkv_flat_order(self.config, device=self.attn.weight.device)
+        with torch.no_grad():
+            self.attn.weight.copy_(self.attn.weight[order])
+            if self.attn.bias is not None:
+                self.attn.bias.copy_(self.attn.bias[order])
+        self.qkv_flat = True
+        self._register_state_dict_hook(_qkv_to_checkpoint_layout)
+
     def scaled_dot_product_attention(
         self, q: torch.Tensor, k: torch.Tensor, v: torch.Tensor, mask: Optional[torch.Tensor] = None
     ) -> torch.Tensor:
-        scale = 1.0 / math.sqrt(self.config.head_size)
-        if not self.config.add_attention_scale:
-            scale = None
+        """Returns the attention output with shape (B, T, nh_q, hs).
+
+        The fused SDPA kernels and FlashAttention write their output in this memory layout, so neither the transpose
+        here nor the reshape in `forward` copies. Only the math fallback produces a (B, nh_q, T, hs) buffer.
+        """
+        if mask is None and _use_flash_attn(q):
+            # imported here so that a flash-attn build that does not match torch cannot break importing litgpt
+            from flash_attn import flash_attn_func
+
+            # takes the (B, T, nh, hs) layout directly and broadcasts the key and value heads over their query group
+            return flash_attn_func(
+                q.transpose(1, 2), k.transpose(1, 2), v.transpose(1, 2), softmax_scale=self.scale, causal=True
+            )
         is_causal = mask is None
+        kwargs = {}
+        if q.size(1) != k.size(1) and mask is None:
+            # the flash kernel broadcasts the key and value heads over their query group. with a mask, the single head
+            # of multi-query attention is broadcasted by the math kernel instead
+            kwargs["enable_gqa"] = True
         y = torch.nn.functional.scaled_dot_product_attention(
-            q, k, v, attn_mask=mask, dropout_p=0.0, scale=scale, is_causal=is_causal
+            q, k, v, attn_mask=mask, dropout_p=0.0, scale=self.scale, is_causal=is_causal, **kwargs
         )
         return y.transpose(1, 2)
 
@@ -332,11 +557,12 @@ class CausalSelfAttention(nn.Module):
         device: Optional[torch.device] = None,
         dtype: Optional[torch.dtype] = None,
     ) -> "KVCache":
+        # the keys and values are stored repeated to `n_head` heads (see `forward`), except for multi-query attention
         heads = 1 if self.config.n_query_groups == 1 else self.config.n_head
         v_shape = (batch_size, heads, max_seq_length, self.config.head_size)
         if rope_cache_length is None and self.config.position_emb_type == "rope":
             if self.config.rotary_percentage != 1.0:
-                raise TypeError("Please pass the `rope_cache_length=gpt.cos.size(-1)` value")
+                raise TypeError("Please pass the `rope_cache_length=2 * gpt.cos.size(-1)` value")
             k_shape = v_shape
         else:
             if self.config.position_emb_type == "rope":
@@ -351,6 +577,47 @@ class CausalSelfAttention(nn.Module):
             )
         return KVCache(k_shape, v_shape, device=device, dtype=dtype)
 
+    def _load_from_state_dict(self, state_dict: Dict, prefix: str, *args: Any, **kwargs: Any) -> None:
+        """Checkpoints use the per query group layout, see `use_flat_qkv_layout`."""
+        if self.qkv_flat:
+            for key in (prefix + "attn.weight", prefix + "attn.bias"):
+                if key in state_dict:
+                    state_dict[key] = state_dict[key][qkv_flat_order(self.config, state_dict[key].device)]
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+
+def _use_flash_attn(q: torch.Tensor) -> bool:
+    """Whether the FlashAttention-2 kernels support these queries. They need an Ampere or newer GPU."""
+    return (
+        _FLASH_ATTN_AVAILABLE
+        and q.is_cuda
+        and q.dtype in (torch.float16, torch.bfloat16)
+        and q.size(-1) <= 256
+        and _cuda_device_capability(q.device.index) >= (8, 0)
+    )
+
+
+@lru_cache(maxsize=None)
+def _cuda_device_capability(index: int) -> Tuple[int, int]:
+    # queried once per device instead of on every attention call
+    return torch.cuda.get_device_capability(index)
+
+
+def qkv_flat_order(config: Config, device: Optional[torch.device] = None) -> torch.Tensor:
+    """Indices that reorder the rows of the qkv projection from the per query group layout to [Q | K | V]."""
+    q_per_kv = config.n_head // config.n_query_groups
+    rows = torch.arange((config.n_head + 2 * config.n_query_groups) * config.head_size, device=device)
+    rows = rows.view(config.n_query_groups, q_per_kv + 2, config.head_size)
+    q, k, v = rows.split((q_per_kv, 1, 1), dim=1)
+    return torch.cat((q.flatten(), k.flatten(), v.flatten()))
+
+
+def _qkv_to_checkpoint_layout(module: CausalSelfAttention, state_dict: Dict, prefix: str, *args: Any) -> None:
+    for key in (prefix + "attn.weight", prefix + "attn.bias"):
+        if key in state_dict:
+            order = qkv_flat_order(module.config, state_dict[key].device)
+            state_dict[key] = state_dict[key][torch.argsort(order)]
+
 
 class GptNeoxMLP(nn.Module):
     def __init__(self, config: Config) -> None:
@@ -391,10 +658,6 @@ class ChatGLM2MLP(nn.Module):
         self.dense_h_to_4h = nn.Linear(config.n_embd, config.intermediate_size * 2,
                                        bias=self.add_bias)
 
-        def swiglu(x):
-            x = torch.chunk(x, 2, dim=-1)
-            return F.silu(x[0]) * x[1]
-
         self.activation_func = swiglu
 
         self.dense_4h_to_h = nn.Linear(config.intermediate_size, config.n_embd,
@@ -407,25 +670,45 @@ class ChatGLM2MLP(nn.Module):
         return out
 
 
+def swiglu(x: torch.Tensor) -> torch.Tensor:
+    # slice the two halves as views instead of going through `torch.chunk`
+    half = x.size(-1) // 2
+    return F.silu(x[..., :half]) * x[..., half:]
+
+
 class NormHead(nn.Module):
+    weight_normalized = False
+
     def __init__(self, hidden_size, vocab_size, bias=False):
         super().__init__()
         self.weight = nn.Parameter(torch.empty((vocab_size, hidden_size)))
         nn.init.kaiming_uniform_(self.weight, a=math.sqrt(5))
-        self.first_flag = True
+
+    def train(self, mode: bool = True) -> Self:
+        # the normalized weight is constant during inference: normalize it once here instead of in `forward`
+        normalize_head_weight(self, normalize=not mode)
+        return super().train(mode)
 
     def forward(self, hidden_states):
-        if self.training:
-            norm_weight = nn.functional.normalize(self.weight)
-            self.first_flag = True
-        elif self.first_flag:
-            self.first_flag = False
-            self.weight.data = nn.functional.normalize(self.weight)
-            norm_weight = self.weight
-        else:
-            norm_weight = self.weight
+        norm_weight = self.weight if self.weight_normalized else nn.functional.normalize(self.weight)
         return nn.functional.linear(hidden_states, norm_weight)
 
+    def _load_from_state_dict(self, state_dict: Dict, prefix: str, *args: Any, **kwargs: Any) -> None:
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+        # weights loaded after `eval()` was called still need to be normalized
+        normalize_head_weight(self, normalize=not self.training)
+
+
+def normalize_head_weight(head: nn.Module, normalize: bool) -> None:
+    """Normalizes the rows of `head.weight` in place and records it in `head.weight_normalized`.
+
+    Only the full 2D matrix is normalized. Under FSDP with `use_orig_params=True` the weight seen outside of `forward`
+    is a flat, possibly empty, shard: it is left as is and `forward` normalizes the unsharded weight instead.
+    """
+    head.weight_normalized = normalize and head.weight.dim() == 2
+    if head.weight_normalized:
+        head.weight.data = nn.functional.normalize(head.weight.data)
+
 
 class GemmaMLP(LLaMAMLP):
     def forward(self, x: torch.Tensor) -> torch.Tensor:
@@ -453,12 +736,7 @@ class LLaMAMoE(nn.Module):
         router = self.gate(x)  # (B*T, n_expert)
         probs, indices = torch.topk(router, self.config.n_expert_per_token)  # (B*T, n_expert_per_token)
         probs = probs.softmax(dim=1, dtype=torch.float).to(dtype=x.dtype)
-        masks = indices.unsqueeze(-1) == torch.arange(self.config.n_expert, device=x.device)
-        masks = masks.permute(2, 0, 1)  # (n_expert, B*T, n_expert_per_token)
-        y = torch.zeros_like(x)  # (B*T, C)
-        for mask, expert in zip(masks, self.experts):
-            token_idx, expert_idx = torch.where(mask)
-            y[token_idx] += probs[token_idx, expert_idx, None] * expert(x[token_idx])
+        y = dispatch_to_experts(x, probs, indices, self.experts)  # (B*T, C)
         return y.view(B, T, C)
 
 
@@ -488,12 +766,7 @@ class Qwen2MoE(nn.Module):
         probs, indices = torch.topk(probs, self.top_k)  # (B*T, n_expert_per_token)
         if self.norm_topk_prob:
             probs /= probs.sum(dim=1, keepdim=True)
-        masks = indices.unsqueeze(-1) == torch.arange(self.num_experts, device=x.device)
-        masks = masks.permute(2, 0, 1)  # (n_expert, B*T, n_expert_per_token)
-        y = torch.zeros_like(x)  # (B*T, C)
-        for mask, expert in zip(masks, self.experts):
-            token_idx, expert_idx = torch.where(mask)
-            y[token_idx] += probs[token_idx, expert_idx, None] * expert(x[token_idx])
+        y = dispatch_to_experts(x, probs, indices, self.experts)  # (B*T, C)
 
         shared_x = self.shared_expert(x)
         shared_x = F.sigmoid(self.shared_expert_gate(x)) * shared_x
@@ -501,6 +774,37 @@ class Qwen2MoE(nn.Module):
         return y.view(B, T, C)
 
 
+def dispatch_to_experts(
+    x: torch.Tensor, probs: torch.Tensor, indices: torch.Tensor, experts: nn.ModuleList
+) -> torch.Tensor:
+    """Runs each token through its selected experts and sums the outputs weighted by the router probabilities.
+
+    The token-expert assignments are sorted by expert once, so every expert reads a contiguous segment of them and the
+    experts that were not selected by any token are skipped entirely.
+
+    Args:
+        x: Tensor of shape (B*T, C) with the tokens.
+        probs: Tensor of shape (B*T, n_expert_per_token) with the routing weights.
+        indices: Tensor of shape (B*T, n_expert_per_token) with the selected experts.
+        experts: The expert modules.
+    """
+    flat_indices = indices.flatten()  # (B*T*n_expert_per_token)
+    order = torch.argsort(flat_indices)
+    # a single host synchronization for the segment lengths, instead of one `torch.where` per expert
+    counts = torch.bincount(flat_indices, minlength=len(experts)).tolist()
+    # gather the tokens and their weights in expert order once, every expert then reads a view of its segment
+    token_idx = order // indices.size(1)
+    xs = x[token_idx].split(counts)
+    weights = probs.flatten()[order].unsqueeze(-1).split(counts)
+    token_idxs = token_idx.split(counts)
+    y = torch.zeros_like(x)  # (B*T, C)
+    for expert, count, x_expert, weight, token_idx in zip(experts, counts, xs, weights, token_idxs):
+        if count == 0:
+            continue
+        y.index_add_(0, token_idx, weight * expert(x_expert))
+    return y
+
+
 def build_rope_cache(
     seq_len: int, n_elem: int, device: Optional[torch.device] = None, base: int = 10000, condense_ratio: int = 1
 ) -> Tuple[torch.Tensor, torch.Tensor]:
@@ -516,36 +820,38 @@ def build_rope_cache(
     # Create position indexes `[0, 1, ..., seq_len - 1]`
     seq_idx = torch.arange(seq_len, device=device) / condense_ratio
 
-    # Calculate the product of position index and $\theta_i$
-    idx_theta = torch.outer(seq_idx, theta).repeat(1, 2)
+    # Calculate the product of position index and $\theta_i$. Both halves of the head share the same angles, so the
+    # cache is kept at `n_elem // 2` instead of being repeated
+    idx_theta = torch.outer(seq_idx, theta)  # (seq_len, n_elem // 2)
 
     return torch.cos(idx_theta), torch.sin(idx_theta)
 
 
 def apply_rope(x: torch.Tensor, cos: torch.Tensor, sin: torch.Tensor, rope_type: str = "default") -> torch.Tensor:
-    if cos.device != x.device:
-        cos = cos.to(x.device)
-        sin = sin.to(x.device)
+    # `cos` and `sin` are (T, hs/2): rotate the two halves directly instead of materializing `cat((-x2, x1))`
     if rope_type == "default":
         head_size = x.size(-1)
         x1 = x[..., : head_size // 2]  # (B, nh, T, hs/2)
         x2 = x[..., head_size // 2 :]  # (B, nh, T, hs/2)
-        rotated = torch.cat((-x2, x1), dim=-1)  # (B, nh, T, hs)
-        roped = (x * cos) + (rotated * sin)
+        roped = torch.cat((x1 * cos - x2 * sin, x2 * cos + x1 * sin), dim=-1)  # (B, nh, T, hs)
     elif rope_type == "chatglm":
         # NOTE: for chatglm it add: @torch.jit.script to apply_rope
         B, nh, T, head_size = x.shape
-        x = x.reshape(B, nh, T, head_size // 2, 2)  # (B, nh, T, hs/2, 2)
-        x1, x2 = x[..., 0], x[..., 1]
-        x = torch.cat((x1, x2), dim=-1)
-        rotated = torch.cat((-x2, x1), dim=-1)  # (B, nh, T, hs)
-        roped = (x * cos) + (rotated * sin)
-        roped = roped.reshape(B, nh, T, 2, head_size//2)
-        roped = roped.permute(0, 1, 2, 4, 3)
-        roped = roped.reshape(B, nh, T, head_size)
+        x_pairs = x.reshape(B, nh, T, head_size // 2, 2)  # (B, nh, T, hs/2, 2)
+        x1, x2 = x_pairs[..., 0], x_pairs[..., 1]
+        roped = torch.stack((x1 * cos - x2 * sin, x2 * cos + x1 * sin), dim=-1)  # (B, nh, T, hs/2, 2)
+        roped = roped.flatten(-2)  # (B, nh, T, hs)
     return roped.type_as(x)
 
 
+def apply_rope_(x: torch.Tensor, cos: torch.Tensor, sin: torch.Tensor, rope_type: str = "default") -> torch.Tensor:
+    """In-place version of `apply_rope`: the rotated values are written back into `x` (which can be a view).
+
+    The rotation goes through `apply_rope` so that executors replacing it (e.g. the thunder unsloth one) still apply.
+    """
+    return x.copy_(apply_rope(x, cos, sin, rope_type))
+
+
 class KVCache(nn.Module):
     def __init__(
         self,
@@ -559,9 +865,13 @@ class KVCache(nn.Module):
         self.register_buffer("v", torch.zeros(v_shape, device=device, dtype=dtype), persistent=False)
 
     def forward(self, input_pos: torch.Tensor, k: torch.Tensor, v: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
-        # move the buffer to the activation dtype for when AMP is used
-        self.k = self.k.to(k.dtype)
-        self.v = self.v.to(v.dtype)
+        # `GPT.set_kv_cache` allocates the buffers in the dtype of the weights. when the activations differ, for
+        # instance with AMP, they are converted once through `.data` instead of converting the whole cache every step.
+        # the conversion allocates new storage, which invalidates a captured CUDA graph
+        if self.k.dtype != k.dtype:
+            self.k.data = self.k.data.to(k.dtype)
+        if self.v.dtype != v.dtype:
+            self.v.data = self.v.data.to(v.dtype)
         # update the cache
         k = self.k.index_copy_(2, input_pos, k)
         v = self.v.index_copy_(2, input_pos, v)
@@ -572,9 +882,18 @@ class KVCache(nn.Module):
         torch.nn.init.zeros_(self.v)
 
 
+def additive_attention_mask(mask: torch.Tensor, dtype: torch.dtype) -> torch.Tensor:
+    """Converts a boolean mask into the additive mask that SDPA adds to the attention scores.
+
+    Built once per step and shared by all the layers, instead of every SDPA call converting the boolean mask.
+    """
+    return torch.zeros(mask.shape, dtype=dtype, device=mask.device).masked_fill_(~mask, float("-inf"))
+
+
 def build_mask_cache(max_seq_length: int, device: Optional[torch.device] = None) -> torch.Tensor:
-    ones = torch.ones((max_seq_length, max_seq_length), device=device, dtype=torch.bool)
-    return torch.tril(ones).unsqueeze(0).unsqueeze(0)
+    # only the position of each kv cache slot is stored: comparing it with `input_pos` gives the rows of the causal mask
+    # without keeping a (max_seq_length, max_seq_length) matrix in memory
+    return torch.arange(max_seq_length, device=device).view(1, 1, 1, max_seq_length)
 
 
 class RMSNorm(torch.nn.Module):
@@ -584,25 +903,35 @@ class RMSNorm(torch.nn.Module):
     https://github.com/bzhangGo/rmsnorm/blob/master/LICENSE.
     """
 
-    def __init__(self, size: int, dim: int = -1, eps: float = 1e-6, add_unit_offset: bool = False) -> None:
+    def __init__(
+        self, size: int, dim: int = -1, eps: float = 1e-6, add_unit_offset: bool = False, fused: bool = False
+    ) -> None:
         super().__init__()
         self.weight = torch.nn.Parameter(torch.ones(size))
         self.eps = eps
         self.dim = dim
         self.add_unit_offset = add_unit_offset
+        # the eager implementation launches a kernel per op. compiling it produces a single kernel that reads `x` once
+        self.norm_fn = torch.compile(rms_norm, fullgraph=True) if fused else rms_norm
 
     def forward(self, x: torch.Tensor) -> torch.Tensor:
-        dtype = x.dtype
-        x = x.float()
-        # NOTE: the original RMSNorm paper implementation is not equivalent
-        norm_x = torch.mean(x * x, dim=self.dim, keepdim=True)
-        x_normed = x * torch.rsqrt(norm_x + self.eps)
-        x_normed = x_normed.to(dtype=dtype)
-        if self.add_unit_offset:
-            # Gemma model requires a unit offset
-            # https://github.com/google/gemma_pytorch/blob/main/gemma/model.py#L176
-            return x_normed * (1 + self.weight)
-        return x_normed * self.weight
+        return self.norm_fn(x, self.weight, self.eps, self.dim, self.add_unit_offset)
 
     def reset_parameters(self) -> None:
         torch.nn.init.ones_(self.weight)
+
+
+def rms_norm(
+    x: torch.Tensor, weight: torch.Tensor, eps: float, dim: int = -1, add_unit_offset: bool = False
+) -> torch.Tensor:
+    dtype = x.dtype
+    x = x.float()
+    # NOTE: the original RMSNorm paper implementation is not equivalent
+    norm_x = torch.mean(x * x, dim=dim, keepdim=True)
+    x_normed = x * torch.rsqrt(norm_x + eps)
+    x_normed = x_normed.to(dtype=dtype)
+    if add_unit_offset:
+        # Gemma model requires a unit offset
+        # https://github.com/google/gemma_pytorch/blob/main/gemma/model.py#L176
+        return x_normed * (1 + weight)
+    return x_normed * weight
@@ -21,6 +21,7 @@ from lightning.fabric.loggers import CSVLogger, TensorBoardLogger
 from lightning.fabric.strategies import FSDPStrategy
 from lightning.fabric.utilities.load import _lazy_load as lazy_load
 from lightning.pytorch.loggers import WandbLogger
+from lightning_utilities.core.imports import RequirementCache
 from torch.serialization import normalize_storage_type
 from typing_extensions import Self
 
@@ -325,6 +326,20 @@ def load_checkpoint(fabric: L.Fabric, model: nn.Module, checkpoint_path: Path, s
         model.load_state_dict(state_dict, strict=strict)
 
 
+def quantize_torchao(model: nn.Module, method: str) -> None:
+    """Replaces the weights of every linear layer, the lm head included, with weight-only quantized ones from torchao.
+
+    The activations keep the precision of the model and the weights are dequantized inside the matmul.
+    """
+    torchao_available = RequirementCache("torchao")
+    if not torchao_available:
+        raise ModuleNotFoundError(str(torchao_available))
+    from torchao.quantization import float8_weight_only, int8_weight_only, quantize_
+
+    quantization = {"torchao.int8wo": int8_weight_only, "torchao.fp8wo": float8_weight_only}[method]
+    quantize_(model, quantization())
+
+
 def flops_per_param(max_seq_length: int, n_layer: int, n_embd: int, n_params: int) -> int:
     flops_per_token = 2 * n_params  # each parameter is used for a MAC (2 FLOPS) per network operation
     # this assumes that all samples have a fixed length equal to the block size
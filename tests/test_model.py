@@ -31,6 +31,7 @@ from transformers.models.mixtral import MixtralConfig, MixtralForCausalLM
 
 import litgpt.config as config_module
 from litgpt import GPT, Config
+from litgpt.model import _TORCH_GREATER_EQUAL_2_5
 from litgpt.scripts.convert_hf_checkpoint import (
     copy_weights_falcon,
     copy_weights_gpt_neox,
@@ -544,6 +545,89 @@ def test_model_compile():
     assert explanation.graph_break_count == 0
 
 
+@RunIf(dynamo=True)
+@pytest.mark.parametrize("mlp_class_name", ("GptNeoxMLP", "LLaMAMoE"))
+@torch.inference_mode()
+def test_compile_block(mlp_class_name):
+    from litgpt.model import _COMPILED_BLOCK_FORWARDS
+
+    kwargs = dict(
+        block_size=8,
+        padded_vocab_size=5,
+        n_layer=3,
+        n_head=4,
+        n_embd=16,
+        mlp_class_name=mlp_class_name,
+        intermediate_size=32,
+        n_expert=4,
+        n_expert_per_token=2,
+    )
+    model = GPT(Config(**kwargs))
+    compiled_model = GPT(Config(**kwargs, compile_block=True))
+    compiled_model.load_state_dict(model.state_dict())
+    # a single compiled function is shared by all the blocks
+    assert len({block._forward_impl for block in compiled_model.transformer.h}) == 1
+    assert compiled_model.transformer.h[0]._forward_impl in _COMPILED_BLOCK_FORWARDS.values()
+
+    x = torch.randint(0, 5, (2, 8))
+    torch.testing.assert_close(compiled_model(x), model(x))
+
+
+@pytest.mark.parametrize(("parallel_residual", "shared_attention_norm"), ((False, False), (True, False), (True, True)))
+@torch.inference_mode()
+def test_block_forward_variants(parallel_residual, shared_attention_norm):
+    import gc
+    import weakref
+
+    from litgpt.model import Block
+
+    config = Config(
+        block_size=8,
+        padded_vocab_size=5,
+        n_layer=1,
+        n_head=4,
+        n_embd=16,
+        parallel_residual=parallel_residual,
+        shared_attention_norm=shared_attention_norm,
+    )
+    model = GPT(config)
+    block = model.transformer.h[0]
+    x = torch.randn(2, 8, config.n_embd)
+    cos, sin = model.cos[:8], model.sin[:8]
+
+    if not parallel_residual:
+        expected = block.attn(block.norm_1(x), cos, sin) + x
+        expected = block.mlp(block.norm_2(expected)) + expected
+    elif shared_attention_norm:
+        expected = block.mlp(block.norm_1(x)) + block.attn(block.norm_1(x), cos, sin) + x
+    else:
+        expected = block.mlp(block.norm_2(x)) + block.attn(block.norm_1(x), cos, sin) + x
+    torch.testing.assert_close(block(x, cos, sin), expected)
+
+    # the selected variant does not keep the block alive through a reference cycle
+    block = Block(config)
+    ref = weakref.ref(block)
+    gc.disable()
+    try:
+        del block
+        assert ref() is None
+    finally:
+        gc.enable()
+
+
+@RunIf(min_cuda_gpus=1, dynamo=True)
+@torch.inference_mode()
+def test_fused_rmsnorm():
+    from litgpt.model import RMSNorm
+
+    x = torch.randn(2, 5, 16, device="cuda", dtype=torch.bfloat16)
+    norm = RMSNorm(16, add_unit_offset=True).to(device="cuda", dtype=torch.bfloat16)
+    fused_norm = RMSNorm(16, add_unit_offset=True, fused=True).to(device="cuda", dtype=torch.bfloat16)
+    torch.nn.init.normal_(norm.weight)
+    fused_norm.load_state_dict(norm.state_dict())
+    torch.testing.assert_close(fused_norm(x), norm(x))
+
+
 @torch.inference_mode()
 @pytest.mark.parametrize(
     "max_seq_length", (25, pytest.param(23, marks=pytest.mark.xfail(raises=IndexError, strict=True)))
@@ -579,6 +663,203 @@ def test_kv_cache(max_seq_length):
         input_pos = input_pos[-1:] + 1
 
 
+@pytest.mark.parametrize(("n_head", "n_query_groups"), ((4, 4), (4, 2)))
+@pytest.mark.parametrize("rotary_percentage", (1.0, 0.5))
+def test_backward(n_head, n_query_groups, rotary_percentage):
+    config = Config(
+        block_size=8,
+        padded_vocab_size=5,
+        n_layer=2,
+        n_head=n_head,
+        n_embd=16,
+        n_query_groups=n_query_groups,
+        rotary_percentage=rotary_percentage,
+    )
+    model = GPT(config)
+    x = torch.randint(0, config.padded_vocab_size, (2, 8))
+    model(x).sum().backward()
+    assert all(p.grad is not None for p in model.parameters())
+
+    # the in-place rotation used without grad gives the same result
+    with torch.no_grad():
+        expected = model(x)
+    torch.testing.assert_close(model(x).detach(), expected)
+
+
+def test_kv_cache_converts_dtype_once():
+    from litgpt.model import KVCache
+
+    kv_cache = KVCache((1, 2, 4, 3), (1, 2, 4, 3), dtype=torch.float32)
+    k_buffer, v_buffer = kv_cache.k, kv_cache.v
+    k, v = torch.randn(1, 2, 1, 3, dtype=torch.bfloat16), torch.randn(1, 2, 1, 3, dtype=torch.bfloat16)
+    k_out, v_out = kv_cache(torch.tensor([1]), k, v)
+    # the buffers are converted in place and returned without a copy
+    assert kv_cache.k is k_buffer and kv_cache.v is v_buffer
+    assert k_out is k_buffer and v_out is v_buffer
+    assert k_buffer.dtype is torch.bfloat16
+    torch.testing.assert_close(k_out[:, :, 1:2], k)
+    torch.testing.assert_close(v_out[:, :, 1:2], v)
+
+
+@pytest.mark.parametrize(("n_head", "n_query_groups"), ((4, 4), (4, 2), (4, 1)))
+def test_flat_qkv_layout(n_head, n_query_groups):
+    config = Config(
+        block_size=8, padded_vocab_size=5, n_layer=2, n_head=n_head, n_embd=16, n_query_groups=n_query_groups, bias=True
+    )
+    model = GPT(config)
+    state_dict = {k: v.clone() for k, v in model.state_dict().items()}
+    idx = torch.randint(0, config.padded_vocab_size, (2, 8))
+    with torch.no_grad():
+        expected = model(idx)
+
+    for block in model.transformer.h:
+        block.attn.use_flat_qkv_layout()
+    assert model.transformer.h[0].attn.qkv_flat
+    with torch.no_grad():
+        torch.testing.assert_close(model(idx), expected)
+
+    # the state dict keeps the checkpoint layout
+    torch.testing.assert_close(model.state_dict(), state_dict)
+    model.load_state_dict(state_dict)
+    with torch.no_grad():
+        torch.testing.assert_close(model(idx), expected)
+
+
+def test_rope_cache_resize():
+    model = GPT(Config(block_size=16, padded_vocab_size=5, n_layer=1, n_head=2, n_embd=8, rope_condense_ratio=2))
+    model.max_seq_length = 5
+    cos, sin = model.rope_cache()
+    assert cos.size(0) == 5
+    torch.testing.assert_close(model.cos, cos)
+    torch.testing.assert_close(model.sin, sin)
+    model.max_seq_length = 12
+    cos, sin = model.rope_cache()
+    torch.testing.assert_close(model.cos, cos)
+    torch.testing.assert_close(model.sin, sin)
+
+
+@RunIf(min_cuda_gpus=1)
+@torch.inference_mode()
+def test_decode_graph():
+    config = Config(block_size=16, padded_vocab_size=5, n_layer=2, n_head=4, n_embd=16, n_query_groups=2)
+    with torch.device("cuda"):
+        model = GPT(config)
+        graph_model = GPT(config)
+        graph_model.load_state_dict(model.state_dict())
+        model.set_kv_cache(1)
+        graph_model.set_kv_cache(1)
+        graph_model.capture_decode_graph(batch_size=1)
+        idx = torch.randint(0, config.padded_vocab_size, (1, 5))
+        input_pos = torch.arange(0, 5)
+
+    for _ in range(5):
+        torch.testing.assert_close(graph_model(idx, input_pos), model(idx, input_pos))
+        idx = torch.randint(0, config.padded_vocab_size, (1, 1), device="cuda")
+        input_pos = input_pos[-1:] + 1
+
+    # a prefill in another dtype reallocates the kv cache that the graph points at
+    with torch.autocast("cuda", dtype=torch.bfloat16):
+        graph_model(idx.repeat(1, 2), torch.arange(0, 2, device="cuda"))
+    with pytest.raises(RuntimeError, match="reallocated"):
+        graph_model(idx, input_pos)
+
+    graph_model.clear_kv_cache()
+    assert graph_model.decode_graph is None
+
+
+def test_decode_graph_moe():
+    config = Config(
+        block_size=16,
+        padded_vocab_size=5,
+        n_layer=1,
+        n_head=4,
+        n_embd=16,
+        mlp_class_name="LLaMAMoE",
+        intermediate_size=32,
+        n_expert=4,
+        n_expert_per_token=2,
+    )
+    model = GPT(config)
+    model.set_kv_cache(1)
+    with pytest.raises(NotImplementedError, match="mixture of experts"):
+        model.capture_decode_graph()
+
+
+def test_consolidate_weights():
+    config = Config(block_size=8, padded_vocab_size=5, n_layer=3, n_head=4, n_embd=16, n_query_groups=2, bias=True)
+    model = GPT(config)
+    state_dict = {k: v.clone() for k, v in model.state_dict().items()}
+    idx = torch.randint(0, config.padded_vocab_size, (2, 8))
+    with torch.no_grad():
+        expected = model(idx)
+
+    model.consolidate_weights()
+    storage = model.transformer.h[0].attn.attn.weight.untyped_storage().data_ptr()
+    assert all(block.attn.attn.weight.untyped_storage().data_ptr() == storage for block in model.transformer.h)
+    torch.testing.assert_close(model.state_dict(), state_dict)
+    with torch.no_grad():
+        torch.testing.assert_close(model(idx), expected)
+
+    # loading copies into the consolidated storage
+    model.load_state_dict(state_dict)
+    assert model.transformer.h[1].attn.attn.weight.untyped_storage().data_ptr() == storage
+
+
+def test_consolidate_weights_skips_parameter_subclasses():
+    class QuantizedParameter(torch.nn.Parameter):
+        pass
+
+    config = Config(block_size=8, padded_vocab_size=5, n_layer=2, n_head=4, n_embd=16)
+    model = GPT(config)
+    for block in model.transformer.h:
+        block.mlp.fc.weight = QuantizedParameter(block.mlp.fc.weight.data, requires_grad=False)
+    weights = [block.mlp.fc.weight for block in model.transformer.h]
+
+    model.consolidate_weights()
+    for block, weight in zip(model.transformer.h, weights):
+        assert block.mlp.fc.weight is weight
+        assert type(block.mlp.fc.weight) is QuantizedParameter
+
+
+@torch.no_grad()
+def test_norm_head():
+    from litgpt.adapter_v2 import AdapterV2NormHead
+    from litgpt.lora import LoRANormHead
+    from litgpt.model import NormHead
+
+    x = torch.randn(2, 3, 8)
+    for head_class in (NormHead, LoRANormHead, AdapterV2NormHead):
+        head = head_class(8, 5)
+        state_dict = {k: v.clone() for k, v in head.state_dict().items()}
+        expected = head(x)
+
+        # weights loaded after `eval()` are normalized once
+        head.eval()
+        head.load_state_dict(state_dict)
+        assert head.weight_normalized
+        torch.testing.assert_close(head.weight, torch.nn.functional.normalize(state_dict["weight"]))
+        torch.testing.assert_close(head(x), expected)
+
+        # a flat shard, as seen outside of `forward` under FSDP, is left as is and `forward` normalizes instead
+        head.train()
+        head.weight = torch.nn.Parameter(state_dict["weight"].flatten())
+        head.eval()
+        assert not head.weight_normalized
+        torch.testing.assert_close(head.weight, state_dict["weight"].flatten())
+        head.weight.data = state_dict["weight"].clone()
+        torch.testing.assert_close(head(x), expected)
+
+
+def test_mask_cache():
+    from litgpt.model import build_mask_cache
+
+    mask_cache = build_mask_cache(6)
+    input_pos = torch.tensor([2, 3, 4])
+    mask = mask_cache <= input_pos.unsqueeze(-1)
+    expected = torch.tril(torch.ones(6, 6, dtype=torch.bool))[input_pos]
+    torch.testing.assert_close(mask, expected.view(1, 1, 3, 6))
+
+
 @torch.inference_mode()
 def test_model_kv_cache_amp():
     config = Config.from_name("pythia-14m", n_layer=2)
@@ -596,6 +877,14 @@ SUPPORTS_FLASH_ATTENTION = (
 )
 
 
+def sdpa_params(q, k, v, mask):
+    # mirrors the call in `CausalSelfAttention.scaled_dot_product_attention`, which sets `enable_gqa` when the key and
+    # value heads reach it without a mask and without being repeated
+    if _TORCH_GREATER_EQUAL_2_5:
+        return SDPAParams(q, k, v, mask, 0.0, True, q.size(1) != k.size(1) and mask is None)
+    return SDPAParams(q, k, v, mask, 0.0, True)
+
+
 @RunIf(min_cuda_gpus=1)
 @pytest.mark.parametrize("config", deepcopy(config_module.configs), ids=[c["name"] for c in config_module.configs])
 @torch.inference_mode()
@@ -603,7 +892,7 @@ def test_sdpa_choice(config):
     torch.set_default_dtype(torch.float16)
 
     def assert_sdpa_backend(original_fn, q, k, v, mask):
-        params = SDPAParams(q, k, v, mask, 0.0, True)
+        params = sdpa_params(q, k, v, mask)
         if expected is SDPBackend.FLASH_ATTENTION:
             assert flash_sdp_enabled()
             assert can_use_flash_attention(params, True)
@@ -640,6 +929,23 @@ def test_sdpa_choice(config):
         model(x)
 
 
+@RunIf(min_cuda_gpus=1)
+@pytest.mark.parametrize("n_query_groups", (4, 2, 1))
+@torch.inference_mode()
+def test_flash_attn(n_query_groups, monkeypatch):
+    import litgpt.model
+
+    if not litgpt.model._FLASH_ATTN_AVAILABLE:
+        pytest.skip("Requires flash-attn")
+    config = Config(block_size=16, padded_vocab_size=5, n_layer=2, n_head=4, n_embd=64, n_query_groups=n_query_groups)
+    with torch.device("cuda"):
+        model = GPT(config).to(torch.bfloat16)
+        x = torch.randint(0, config.padded_vocab_size, (2, 16))
+    actual = model(x)
+    monkeypatch.setattr(litgpt.model, "_FLASH_ATTN_AVAILABLE", False)
+    torch.testing.assert_close(actual, model(x))
+
+
 @RunIf(min_cuda_gpus=1)
 @pytest.mark.parametrize("config", deepcopy(config_module.configs), ids=[c["name"] for c in config_module.configs])
 @torch.inference_mode()
@@ -647,7 +953,7 @@ def test_sdpa_choice_kv_cache(config):
     torch.set_default_dtype(torch.float16)
 
     def assert_sdpa_backend(original_fn, q, k, v, mask):
-        params = SDPAParams(q, k, v, mask, 0.0, True)
+        params = sdpa_params(q, k, v, mask)
         if expected is SDPBackend.FLASH_ATTENTION:
             assert flash_sdp_enabled()
             assert can_use_flash_attention(params, True)
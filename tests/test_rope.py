@@ -1,9 +1,10 @@
 # Copyright Lightning AI. Licensed under the Apache License 2.0, see LICENSE file.
 
+import pytest
 import torch
 from transformers.models.gpt_neox.modeling_gpt_neox import GPTNeoXRotaryEmbedding, apply_rotary_pos_emb
 
-from litgpt.model import apply_rope, build_rope_cache
+from litgpt.model import apply_rope, apply_rope_, build_rope_cache
 
 
 @torch.inference_mode()
@@ -15,10 +16,23 @@ def test_rope():
 
     theirs = GPTNeoXRotaryEmbedding(head_size, seq_len)
     ours_cos_cached, ours_sin_cached = build_rope_cache(seq_len, head_size, device=x.device)
-    # their rope cache has 2 added dimensions and the cos/sin is duplicated
-    torch.testing.assert_close(ours_cos_cached, theirs.cos_cached.squeeze())
-    torch.testing.assert_close(ours_sin_cached, theirs.sin_cached.squeeze())
+    # their rope cache has 2 added dimensions and the cos/sin is duplicated, ours only stores one half
+    torch.testing.assert_close(ours_cos_cached, theirs.cos_cached.squeeze()[:, : head_size // 2])
+    torch.testing.assert_close(ours_sin_cached, theirs.sin_cached.squeeze()[:, : head_size // 2])
 
     ours_x_rope = apply_rope(x, ours_cos_cached, ours_sin_cached)
     theirs_x_rope, _ = apply_rotary_pos_emb(x, x, theirs.cos_cached, theirs.sin_cached, position_ids)
     torch.testing.assert_close(ours_x_rope, theirs_x_rope)
+
+
+@torch.inference_mode()
+@pytest.mark.parametrize("rope_type", ("default", "chatglm"))
+def test_rope_inplace(rope_type):
+    bs, seq_len, n_head, head_size, n_elem = 2, 6, 3, 8, 4
+    x = torch.randn(bs, n_head, seq_len, head_size)
+    cos, sin = build_rope_cache(seq_len, n_elem)
+
+    expected = torch.cat((apply_rope(x[..., :n_elem], cos, sin, rope_type), x[..., n_elem:]), dim=-1)
+    actual = x.clone()
+    apply_rope_(actual[..., :n_elem], cos, sin, rope_type)
+    torch.testing.assert_close(actual, expected)